@@ -4,241 +4,579 @@
 （即在declare之前调用函数，但函数定义在调用之后）
 """
 
+import argparse
+import functools
+import itertools
+import json
+import mmap
 import os
 import re
 import sys
+import tempfile
 from pathlib import Path
-from typing import List, Dict, Set, Tuple, Optional
+from typing import Iterator, List, Dict, Set, Tuple, Optional
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+# 并行分析时每次提交给工作进程的文件数
+_CHUNK_SIZE = 16
+
+# 解析结果缓存，相对于分析根目录；解析结果的结构或解析规则变化时需递增 SCHEMA_VERSION
+_CACHE_FILE = os.path.join('.cache', 'clj-declare-analy.json')
+SCHEMA_VERSION = 7
+
+# 缓存键：(路径, st_mtime_ns, st_size)
+_CacheKey = Tuple[str, int, int]
+
+# 调用检测时跳过的关键字、特殊形式和 clojure.core 常用函数
+_CLOJURE_CORE_SYMBOLS = frozenset((
+    'if', 'when', 'let', 'fn', 'def', 'defn', 'ns', 'require', 'import', 'set!',
+    'do', 'cond', 'case', 'try', 'catch', 'finally', 'throw', '->', '->>',
+    'doto', 'and', 'or', 'not', 'nil?', 'some?', 'if-let', 'when-let',
+    'when-not', 'if-not', 'cond->', 'cond->>', 'some->', 'some->>', 'as->',
+    'loop', 'recur', 'reify', 'proxy', 'extend', 'extend-type',
+    'extend-protocol', 'deftype', 'defrecord', 'defprotocol', 'definterface',
+    'gen-class', 'gen-interface', 'declare', 'quote', 'var', 'deref', 'ref',
+    'atom', 'agent', 'future', 'delay', 'promise', 'locking', 'monitor-enter',
+    'monitor-exit', 'time', 'with-local-vars', 'binding', 'with-bindings',
+    'with-redefs', 'with-redefs-fn', 'alter-var-root', 'swap!', 'reset!',
+    'compare-and-set!', 'commute', 'ensure', 'dosync', 'io!', 'sync', 'ref-set',
+    'alter', 'ref-history-count', 'ref-max-history', 'ref-min-history',
+    'ref-snapshots', 'ref-ensure', 'partial', 'comp', 'juxt', 'complement',
+    'constantly', 'identity', 'fnil', 'every-pred', 'some-fn', 'apply', 'map',
+    'mapv', 'mapcat', 'filter', 'filterv', 'remove', 'keep', 'keep-indexed',
+    'distinct', 'distinct?', 'concat', 'cons', 'conj', 'into', 'reduce',
+    'reductions', 'take', 'drop', 'take-while', 'drop-while', 'split-at',
+    'split-with', 'partition', 'partition-all', 'partition-by', 'interleave',
+    'interpose', 'cycle', 'repeat', 'repeatedly', 'iterate', 'range', 'rest',
+    'next', 'fnext', 'nnext', 'ffirst', 'nfirst', 'first', 'last', 'butlast',
+    'drop-last', 'take-last', 'take-nth', 'nth', 'nthnext', 'nthrest',
+    'frequencies', 'group-by', 'vals', 'keys', 'key', 'val', 'seq', 'vector',
+    'list', 'hash-map', 'array-map', 'sorted-map', 'sorted-map-by',
+    'sorted-set', 'sorted-set-by', 'hash-set', 'set', 'contains?', 'get',
+    'get-in', 'assoc', 'assoc-in', 'dissoc', 'dissoc-in', 'update', 'update-in',
+    'merge', 'merge-with', 'select-keys', 'zipmap', 'into-array', 'to-array',
+    'alength', 'aget', 'aset', 'make-array', 'vector-of', 'boolean-array',
+    'byte-array', 'char-array', 'short-array', 'int-array', 'long-array',
+    'float-array', 'double-array', 'object-array', 'str', 'string?', 'keyword',
+    'keyword?', 'symbol', 'symbol?', 'name', 'namespace', 'ident?',
+    'simple-ident?', 'qualified-ident?', 'qualified-keyword?',
+    'qualified-symbol?', 'simple-keyword?', 'simple-symbol?', 'gensym',
+    'format', 'printf', 'print', 'println', 'pr', 'prn', 'pr-str', 'prn-str',
+    'print-str', 'println-str', 'with-out-str', 'with-in-str', 'read',
+    'read-string', 'read-line', 'line-seq', 'slurp', 'spit', 'reader', 'writer',
+    'input-stream', 'output-stream', 'file-seq', 'sh', 'shutdown-agents',
+    'halt-when', 'halt-when!', 'error-handler', 'error-mode', 'send',
+    'send-off', 'send-via', 'restart-agent', 'await', 'await-for', 'await1',
+    'await-for1', 'agent-error', 'agent-errors', 'set-error-handler!',
+    'set-error-mode!', 'add-watch', 'remove-watch', 'notify-watches',
+    'add-watcher', 'remove-watcher', 'notify-watchers', 'realized?'
+))
+
+# 同一集合的 bytes 版本：扫描时直接用匹配到的原始字节查表，被跳过的符号无需解码
+_CLOJURE_CORE_SYMBOLS_BYTES = frozenset(symbol.encode('ascii') for symbol in _CLOJURE_CORE_SYMBOLS)
+
+
+# 预编译的正则，避免重复编译；直接扫描文件的 mmap，所以文件级模式都是 bytes 模式
+_RE_AS = re.compile(rb':as\s+(\S+)')
+
+# 行首分支：行首的 def/defn、行首的 declare；[^\S\n] 表示除换行外的空白。
+# def 符号前的 ^:private、^String 之类元数据在同一次匹配中跳过，不再另做替换
+_LINE_HEAD = rb"""
+    [^\S\n]*(?:
+        \(def(?:n)?[^\S\n]+(?:\^:?[\w\-.?!]+[^\S\n]+)*(?P<def>[^\s()]+)
+      | \(declare[^\S\n]+(?P<declare>[^()\n]+)\)
+    )
+"""
 
+# 整文件扫描用的组合模式，每个分支一个命名分组，由 lastgroup 区分，
+# 一次扫描即可识别文件中所有关心的形式，ns 和 (:require ...) 也不再单独扫描。
+# 注释、字符串（含 #"正则"）和字符字面量 \x 整段吞掉，其中的括号不会被误认为调用；
+# 这几个分支的命名分组是跟在首字符后的空分组，只用来标记种类。
+# 每个分支都以字面字符开头（行首分支用 \n 而不用 ^，分组也不放在最前面），
+# 整个模式只可能从 \n ( ; " \ 之一开始匹配，正则引擎可以按首字符快速跳过
+# 其余位置；第一行单独用 _RE_LINE_HEAD 匹配。
+# :require 的内容放在前瞻里捕获，不消耗其中可能出现的调用。
+# 调用分支要求符号后的空白之后本行还有内容（行尾的 (symbol 不算调用），
+# 并且不以大写字母或 . 开头：Java类的构造、静态调用和 (.method obj) 方法调用
+# 都不可能带本文件的命名空间前缀，在正则里就被排除
+_RE_LINE_HEAD = re.compile(_LINE_HEAD, re.X)
+_SKIPPED_KINDS = ('comment', 'string', 'char')
+_RE_FORM = re.compile(rb"\n" + _LINE_HEAD + rb"""
+  | ;(?P<comment>)[^\n]*
+  | "(?P<string>)[^"\\]*(?:\\[\s\S][^"\\]*)*"
+  | \\(?P<char>).
+  | \(ns\s+(?P<ns>[^\s)]+)
+  | \(:require(?=\s+\[(?P<require>[^\]]+)\])
+  | \((?P<call>[a-z_\-?!][a-zA-Z0-9_\-.?!]*)[^\S\n](?=[^\S\n]*\S)
+""", re.X)
+
+
+def parse_file(file_path: str) -> Dict:
+    """解析Clojure文件，提取函数定义、declare和函数调用"""
+    # 存储结果
+    result = {
+        'definitions': {},  # {symbol: line_number}
+        'declares': set(),  # {symbol}
+        # 每个被调用符号只记最早一次调用的行号
+        'earliest_call': {},  # {symbol: line_number}
+        'namespaces': set(),  # 命名空间前缀，用于过滤外部调用
+    }
+
+    with open(file_path, 'rb') as f:
+        # 空文件无法 mmap，也没有可分析的内容
+        if os.fstat(f.fileno()).st_size == 0:
+            return result
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            _scan(mm, result)
+
+    return result
+
+
+def _scan(mm: mmap.mmap, result: Dict):
+    """扫描文件内容并填充 result；只解码命中的符号，不解码整个文件"""
+    # 整个文件一次正则扫描，按命中的分支分派；行号由命中位置前的换行数推算
+    head = _RE_LINE_HEAD.match(mm)
+    matches = _RE_FORM.finditer(mm, head.end() if head else 0)
+    if head:
+        matches = itertools.chain((head,), matches)
+    line_num = 1
+    pos = 0
+    ns_seen = False
+    earliest_call = result['earliest_call']
+    for match in matches:
+        kind = match.lastgroup
+
+        # 提取函数调用 - 查找 (symbol ...) 形式的调用；命中次数最多，最先处理，
+        # 被跳过的符号不再推算行号
+        if kind == 'call':
+            # 跳过关键字、特殊形式等
+            raw = match.group(kind)
+            if raw in _CLOJURE_CORE_SYMBOLS_BYTES:
+                continue
 
-class ClojureAnalyzer:
-    """Clojure代码分析器"""
-
-    def __init__(self):
-        self.issues: List[Tuple[str, int, str]] = []  # (file, line, message)
-
-    def find_clj_files(self, root_dir: str) -> List[Path]:
-        """查找所有.clj文件"""
-        clj_files = []
-        root = Path(root_dir)
-        for path in root.rglob("*.clj"):
-            # 跳过build目录
-            if "build" not in str(path):
-                clj_files.append(path)
-        return sorted(clj_files)
-
-    def parse_file(self, file_path: Path) -> Dict:
-        """解析Clojure文件，提取函数定义、declare和函数调用"""
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            content = f.read()
-            lines = content.split('\n')
-
-        # 存储结果
-        result = {
-            'definitions': {},  # {symbol: line_number}
-            'declares': set(),  # {symbol}
-            'calls': [],  # [(line_number, symbol)]
-            'namespaces': set(),  # 命名空间前缀，用于过滤外部调用
-        }
+            # 调用符号只含 ASCII 字符，直接解码。
+            # 同名符号驻留为同一个对象，省内存，查表时也可以按指针比较
+            symbol = sys.intern(raw.decode('ascii'))
+            # 只记录每个符号的第一次调用，之后的调用不再推算行号
+            if symbol in earliest_call:
+                continue
 
-        # 提取命名空间
-        ns_match = re.search(r'\(ns\s+([^\s\)]+)', content)
-        if ns_match:
-            ns_name = ns_match.group(1)
-            result['namespaces'].add(ns_name)
-            # 也添加可能的别名
-            result['namespaces'].add(ns_name.split('.')[-1])
+            start = match.start(kind)
+            line_num += mm[pos:start].count(b'\n')
+            pos = start
+            earliest_call[symbol] = line_num
+            continue
+
+        # 跳过注释、字符串和字符字面量
+        if kind in _SKIPPED_KINDS:
+            continue
+
+        # 提取命名空间，只取第一个 ns
+        if kind == 'ns':
+            if not ns_seen:
+                ns_seen = True
+                ns_name = match.group(kind).decode('utf-8', 'ignore')
+                result['namespaces'].add(ns_name)
+                # 也添加可能的别名
+                result['namespaces'].add(ns_name.split('.')[-1])
+            continue
 
         # 提取:require中的别名
-        require_pattern = r':require\s+\[([^\]]+)\]'
-        for match in re.finditer(require_pattern, content, re.MULTILINE | re.DOTALL):
-            require_content = match.group(1)
+        if kind == 'require':
             # 匹配 :as alias
-            as_matches = re.findall(r':as\s+(\S+)', require_content)
-            for alias in as_matches:
-                result['namespaces'].add(alias)
-
-        # 逐行分析
-        for line_num, line in enumerate(lines, 1):
-            stripped = line.strip()
-
-            # 跳过注释和空行
-            if not stripped or stripped.startswith(';'):
-                continue
-
-            # 提取函数定义 (defn symbol ...) 或 (def symbol ...)
-            def_match = re.search(r'\(def(?:n)?\s+([^\s\)]+)', stripped)
-            if def_match:
-                symbol = def_match.group(1)
-                # 移除可能的元数据标记
-                symbol = re.sub(r'^\^?[:\w]+\s+', '', symbol).strip()
-                if symbol and not symbol.startswith('('):
-                    result['definitions'][symbol] = line_num
-
-            # 提取declare (declare symbol1 symbol2 ...)
-            declare_match = re.search(r'\(declare\s+([^\)]+)\)', stripped)
-            if declare_match:
-                symbols_str = declare_match.group(1)
-                # 分割多个符号
-                symbols = re.findall(r'([^\s\)]+)', symbols_str)
-                for symbol in symbols:
-                    result['declares'].add(symbol)
-
-            # 提取函数调用 - 查找 (symbol ...) 形式的调用
-            # 但排除一些特殊情况
-            call_pattern = r'\(([a-zA-Z_\-\.\?\!]+[a-zA-Z0-9_\-\.\?\!]*)\s+'
-            for match in re.finditer(call_pattern, stripped):
-                symbol = match.group(1)
-
-                # 跳过关键字、特殊形式、Java类等
-                if symbol in ['if', 'when', 'let', 'fn', 'def', 'defn', 'ns',
-                             'require', 'import', 'set!', 'do', 'cond', 'case',
-                             'try', 'catch', 'finally', 'throw', '->', '->>',
-                             'doto', 'and', 'or', 'not', 'nil?', 'some?', 'if-let',
-                             'when-let', 'when-not', 'if-not', 'cond->', 'cond->>',
-                             'some->', 'some->>', 'as->', 'loop', 'recur', 'reify',
-                             'proxy', 'extend', 'extend-type', 'extend-protocol',
-                             'deftype', 'defrecord', 'defprotocol', 'definterface',
-                             'gen-class', 'gen-interface', 'declare', 'quote',
-                             'var', 'deref', 'ref', 'atom', 'agent', 'future',
-                             'delay', 'promise', 'locking', 'monitor-enter',
-                             'monitor-exit', 'time', 'with-local-vars', 'binding',
-                             'with-bindings', 'with-redefs', 'with-redefs-fn',
-                             'alter-var-root', 'swap!', 'reset!', 'compare-and-set!',
-                             'commute', 'ensure', 'dosync', 'io!', 'sync', 'ref-set',
-                             'alter', 'commute', 'ref-history-count', 'ref-max-history',
-                             'ref-min-history', 'ref-snapshots', 'ref-ensure',
-                             'partial', 'comp', 'juxt', 'complement', 'constantly',
-                             'identity', 'constantly', 'fnil', 'every-pred', 'some-fn',
-                             'apply', 'map', 'mapv', 'mapcat', 'filter', 'filterv',
-                             'remove', 'keep', 'keep-indexed', 'distinct', 'distinct?',
-                             'concat', 'cons', 'conj', 'into', 'reduce', 'reductions',
-                             'take', 'drop', 'take-while', 'drop-while', 'split-at',
-                             'split-with', 'partition', 'partition-all', 'partition-by',
-                             'interleave', 'interpose', 'cycle', 'repeat', 'repeatedly',
-                             'iterate', 'range', 'rest', 'next', 'fnext', 'nnext',
-                             'ffirst', 'nfirst', 'first', 'last', 'butlast', 'drop-last',
-                             'take-last', 'take-nth', 'nth', 'nthnext', 'nthrest',
-                             'frequencies', 'group-by', 'vals', 'keys', 'key', 'val',
-                             'seq', 'vector', 'list', 'hash-map', 'array-map', 'sorted-map',
-                             'sorted-map-by', 'sorted-set', 'sorted-set-by', 'hash-set',
-                             'set', 'contains?', 'get', 'get-in', 'assoc', 'assoc-in',
-                             'dissoc', 'dissoc-in', 'update', 'update-in', 'merge',
-                             'merge-with', 'select-keys', 'zipmap', 'into-array',
-                             'to-array', 'into-array', 'alength', 'aget', 'aset',
-                             'make-array', 'vector-of', 'boolean-array', 'byte-array',
-                             'char-array', 'short-array', 'int-array', 'long-array',
-                             'float-array', 'double-array', 'object-array',
-                             'str', 'string?', 'keyword', 'keyword?', 'symbol',
-                             'symbol?', 'name', 'namespace', 'ident?', 'simple-ident?',
-                             'qualified-ident?', 'qualified-keyword?', 'qualified-symbol?',
-                             'simple-keyword?', 'simple-symbol?', 'gensym', 'gensym',
-                             'format', 'printf', 'print', 'println', 'pr', 'prn',
-                             'pr-str', 'prn-str', 'print-str', 'println-str',
-                             'with-out-str', 'with-in-str', 'read', 'read-string',
-                             'read-line', 'line-seq', 'slurp', 'spit', 'reader',
-                             'writer', 'input-stream', 'output-stream', 'file-seq',
-                             'sh', 'shutdown-agents', 'halt-when', 'halt-when!',
-                             'error-handler', 'error-mode', 'send', 'send-off',
-                             'send-via', 'restart-agent', 'await', 'await-for',
-                             'await1', 'await-for1', 'agent-error', 'agent-errors',
-                             'set-error-handler!', 'set-error-mode!', 'error-handler',
-                             'error-mode', 'add-watch', 'remove-watch', 'notify-watches',
-                             'add-watcher', 'remove-watcher', 'notify-watchers',
-                             'realized?', 'deref', 'deref', 'deref', 'deref',
-                             'realized?', 'realized?', 'realized?', 'realized?']:
-                    continue
-
-                # 跳过带命名空间前缀的调用（可能是外部库）
-                if '.' in symbol and not any(symbol.startswith(ns + '.') for ns in result['namespaces']):
-                    continue
+            for alias in _RE_AS.findall(match.group(kind)):
+                result['namespaces'].add(alias.decode('utf-8', 'ignore'))
+            continue
+
+        start = match.start(kind)
+        line_num += mm[pos:start].count(b'\n')
+        pos = start
+
+        # 提取函数定义 (defn symbol ...) 或 (def symbol ...)
+        if kind == 'def':
+            symbol = match.group(kind).decode('utf-8', 'ignore')
+            result['definitions'][sys.intern(symbol)] = line_num
+
+        # 提取declare (declare symbol1 symbol2 ...)
+        else:
+            # 分割多个符号（分支已保证其中没有括号，按空白切分即可）
+            symbols = match.group(kind).decode('utf-8', 'ignore').split()
+            for symbol in symbols:
+                result['declares'].add(sys.intern(symbol))
+
+    # 跳过带命名空间前缀的调用（可能是外部库）；
+    # 带 . 的调用要等命名空间和别名都收集完后再过滤
+    dotted_calls = [symbol for symbol in earliest_call if '.' in symbol]
+    if dotted_calls:
+        # 命名空间前缀，供 startswith 一次性匹配
+        ns_prefixes = tuple(ns + '.' for ns in result['namespaces'])
+        for symbol in dotted_calls:
+            if not symbol.startswith(ns_prefixes):
+                del earliest_call[symbol]
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_cached(file_path: str, mtime_ns: int, size: int) -> Dict:
+    """进程内按 (路径, mtime, 大小) 缓存的 parse_file，后两个参数只用作缓存键
+
+    只对在同一进程中反复调用 analyze_file 的调用方有用；
+    analyze_directory 每个文件只解析一次，不经过这里，以免结果常驻内存
+    """
+    return parse_file(file_path)
+
+
+def _parse_one(key: _CacheKey, cached: bool = False
+               ) -> Tuple[_CacheKey, Optional[Dict], Optional[str]]:
+    """解析单个文件，返回 (key, result, error)
+
+    纯函数、无共享状态，可直接交给进程池并行执行；cached 为 True 时经过 _parse_cached
+    """
+    try:
+        if cached:
+            return key, _parse_cached(*key), None
+        return key, parse_file(key[0]), None
+    except Exception as e:
+        return key, None, f"分析文件时出错: {str(e)}"
+
+
+def _parse_batch(keys: List[_CacheKey]) -> List[Tuple[_CacheKey, Optional[Dict], Optional[str]]]:
+    """在工作进程中解析一块文件，摊薄进程间通信的开销"""
+    return [_parse_one(key) for key in keys]
+
+
+def _submit_all(executor: ProcessPoolExecutor, fn, items: List) -> Dict:
+    """依次提交任务，返回 {future: item}；进程池中途崩溃时停止提交，只返回已提交的部分"""
+    futures = {}
+    for item in items:
+        try:
+            futures[executor.submit(fn, item)] = item
+        except BrokenProcessPool:
+            break
+    return futures
+
+
+def check_file(result: Dict) -> List[Tuple[int, str]]:
+    """根据解析结果检查声明顺序，返回 (line, message) 列表
+
+    每个符号只检查最早的一次调用，同一符号在一个文件中最多报告一次
+    """
+    issues = []
+    definitions = result['definitions']
+    earliest_call = result['earliest_call']
+
+    # 先建“符号 -> 定义行”查找表，已声明的符号不放进表里；
+    # 查不到记 0（行号从 1 开始，不会晚于任何调用），定义行晚于调用行即为问题
+    declares = result['declares']
+    if declares:
+        def_line_of = {symbol: line for symbol, line in definitions.items()
+                       if symbol not in declares}
+    else:
+        def_line_of = definitions
+
+    # 只有“已定义且未声明”的符号可能出问题；没有这样的符号或没有调用时直接返回
+    if not def_line_of or not earliest_call:
+        return issues
+
+    # 如果符号既未定义也未声明，可能是外部函数，不报告
+    # （因为可能是从其他命名空间导入的）
+    for symbol, call_line in earliest_call.items():
+        def_line = def_line_of.get(symbol, 0)
+        if def_line <= call_line:
+            continue
+        # 发现潜在问题：调用在定义之前，且没有declare
+        issues.append((
+            call_line,
+            f"函数 '{symbol}' 在第 {call_line} 行被调用，但在第 {def_line} 行才定义（缺少declare）"
+        ))
+
+    return issues
+
+
+def _result_to_json(result: Dict) -> Dict:
+    """解析结果转为可 JSON 序列化的形式（集合转为列表）"""
+    return {
+        'definitions': result['definitions'],
+        'declares': sorted(result['declares']),
+        'earliest_call': result['earliest_call'],
+        'namespaces': sorted(result['namespaces']),
+    }
+
+
+def _result_from_json(data: Dict) -> Dict:
+    """_result_to_json 的逆变换；结构不符时抛出异常"""
+    if not (isinstance(data['definitions'], dict) and isinstance(data['earliest_call'], dict)):
+        raise ValueError("缓存条目格式错误")
+    return {
+        'definitions': data['definitions'],
+        'declares': set(data['declares']),
+        'earliest_call': data['earliest_call'],
+        'namespaces': set(data['namespaces']),
+    }
+
+
+def _key_from_json(key: List) -> _CacheKey:
+    """缓存键从 JSON 列表还原为 (路径, mtime, 大小)"""
+    file_path, mtime_ns, size = key
+    return file_path, int(mtime_ns), int(size)
 
-                # 跳过Java类方法调用（通常是大写开头或包含$）
-                if symbol[0].isupper() or '$' in symbol:
-                    continue
 
-                # 记录函数调用
-                result['calls'].append((line_num, symbol))
+class ClojureAnalyzer:
+    """Clojure代码分析器"""
 
-        return result
+    def __init__(self, stream: bool = False):
+        # stream 为 True 时发现问题立即输出，只计数不保存
+        self.stream = stream
+        self.issue_count = 0
+        # 按文件分组记录问题：file -> [(line, message)]
+        self.issues_by_file: Dict[str, List[Tuple[int, str]]] = defaultdict(list)
+
+    @property
+    def issues(self) -> List[Tuple[str, int, str]]:
+        """展开为 (file, line, message) 列表；流式输出时问题不保存，总为空"""
+        return [(file_path, line_num, message)
+                for file_path, file_issues in self.issues_by_file.items()
+                for line_num, message in file_issues]
+
+    def find_clj_files(self, root_dir: str) -> List[str]:
+        """查找所有.clj文件"""
+        return sorted(self._walk_clj_files(root_dir))
 
-    def analyze_file(self, file_path: Path):
+    def _walk_clj_files(self, dir_path: str) -> Iterator[str]:
+        """递归遍历目录，在目录层面直接剪掉build目录"""
+        # 与 Path.rglob 一致，跳过无权限读取的目录
+        try:
+            it = os.scandir(dir_path)
+        except PermissionError:
+            return
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    # 跳过build目录
+                    if entry.name == 'build':
+                        continue
+                    yield from self._walk_clj_files(entry.path)
+                elif entry.name.endswith('.clj'):
+                    yield entry.path
+
+    def analyze_file(self, file_path: str):
         """分析单个文件"""
         try:
-            result = self.parse_file(file_path)
-
-            # 检查每个函数调用
-            for call_line, symbol in result['calls']:
-                # 如果符号已声明，跳过
-                if symbol in result['declares']:
-                    continue
+            stat = os.stat(file_path)
+        except OSError as e:
+            self._collect(file_path, None, f"分析文件时出错: {str(e)}")
+            return
+        _, result, error = _parse_one((file_path, stat.st_mtime_ns, stat.st_size), cached=True)
+        self._collect(file_path, result, error)
 
-                # 如果符号已定义，检查定义是否在调用之后
-                if symbol in result['definitions']:
-                    def_line = result['definitions'][symbol]
-                    if def_line > call_line:
-                        # 发现潜在问题：调用在定义之前，且没有declare
-                        self.issues.append((
-                            str(file_path),
-                            call_line,
-                            f"函数 '{symbol}' 在第 {call_line} 行被调用，但在第 {def_line} 行才定义（缺少declare）"
-                        ))
-                # 如果符号既未定义也未声明，可能是外部函数，暂时不报告
-                # （因为可能是从其他命名空间导入的）
-
-        except Exception as e:
-            self.issues.append((
-                str(file_path),
-                0,
-                f"分析文件时出错: {str(e)}"
-            ))
-
-    def analyze_directory(self, root_dir: str):
-        """分析目录中的所有.clj文件"""
+    def _collect(self, file_path: str, result: Optional[Dict], error: Optional[str]):
+        """检查解析结果并记录问题"""
+        file_issues = [(0, error)] if error is not None else check_file(result)
+        if not file_issues:
+            return
+        self.issue_count += len(file_issues)
+        if self.stream:
+            for line_num, message in file_issues:
+                print(f"{file_path}:{line_num}: {message}")
+            # 逐文件刷新，管道输出（如CI日志）也能及时看到进度
+            sys.stdout.flush()
+        else:
+            self.issues_by_file[file_path].extend(file_issues)
+
+    def analyze_directory(self, root_dir: str, jobs: Optional[int] = None,
+                          use_cache: bool = True) -> int:
+        """分析目录中的所有.clj文件，返回发现的问题数
+
+        jobs 为进程数，None 表示使用全部CPU核心，1 表示在当前进程中串行分析。
+        use_cache 为 True 时，未修改文件的解析结果从 root_dir 下的缓存读取
+        """
         clj_files = self.find_clj_files(root_dir)
         print(f"找到 {len(clj_files)} 个Clojure文件，开始分析...\n")
 
-        for file_path in clj_files:
-            self.analyze_file(file_path)
+        cache_path = os.path.join(root_dir, _CACHE_FILE)
+        cache = self._load_cache(cache_path) if use_cache else {}
+        fresh_cache: Dict[str, Tuple[_CacheKey, Dict]] = {}
 
-        return self.issues
+        # 按 (路径, mtime, 大小) 判断缓存是否仍然有效，只解析变化过的文件；
+        # 命中缓存的文件当场检查，其余文件解析完成一个检查一个
+        pending: List[_CacheKey] = []
+        for file_path in clj_files:
+            try:
+                stat = os.stat(file_path)
+            except OSError as e:
+                self._collect(file_path, None, f"分析文件时出错: {str(e)}")
+                continue
+            key = (file_path, stat.st_mtime_ns, stat.st_size)
+            # 不读写缓存时 cache 为空，不会命中，fresh_cache 也就保持为空
+            cached = cache.get(file_path)
+            if cached is not None and cached[0] == key:
+                self._collect(file_path, cached[1], None)
+                fresh_cache[file_path] = cached
+            else:
+                pending.append(key)
+
+        for key, result, error in self._parse_all(pending, jobs):
+            self._collect(key[0], result, error)
+            # 不写缓存时检查完即丢弃解析结果，不留到分析结束
+            if use_cache and result is not None:
+                fresh_cache[key[0]] = (key, result)
+
+        # 只保留本次仍存在的文件，已删除文件的条目随之清除
+        if use_cache and (pending or len(fresh_cache) != len(cache)):
+            self._save_cache(cache_path, fresh_cache)
+
+        return self.issue_count
+
+    def _parse_all(self, keys: List[_CacheKey], jobs: Optional[int]):
+        """解析一批文件，按完成顺序产出结果，jobs 含义同 analyze_directory"""
+        if not keys:
+            return
+        if jobs == 1:
+            yield from map(_parse_one, keys)
+            return
+        # 每个文件的分析互不依赖，分块提交以摊薄进程间通信的开销；
+        # 哪块先完成就先产出哪块，不按提交顺序等待
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            batches = [keys[i:i + _CHUNK_SIZE] for i in range(0, len(keys), _CHUNK_SIZE)]
+            futures = _submit_all(executor, _parse_batch, batches)
+            # 进程池在提交途中就崩溃时，没提交上的块同样需要重新解析
+            unfinished: List[_CacheKey] = [key for batch in batches[len(futures):] for key in batch]
+            for future in as_completed(futures):
+                try:
+                    batch = future.result()
+                except BrokenProcessPool:
+                    # 一个工作进程崩溃（如文件被截断时 mmap 触发 SIGBUS）会让所有未完成的块
+                    # 一起失败，无法区分是哪个文件导致的，留待下面重新解析
+                    unfinished.extend(futures[future])
+                    continue
+                except Exception as e:
+                    batch = [(key, None, f"分析文件时出错: {str(e)}") for key in futures[future]]
+                yield from batch
+        if unfinished:
+            yield from self._reparse_unfinished(unfinished, jobs)
+
+    def _reparse_unfinished(self, keys: List[_CacheKey], jobs: Optional[int]):
+        """进程池崩溃后重新解析未完成的文件，只把真正导致崩溃的文件记为出错
+
+        先在新进程池中每个文件单独提交一次；若再次崩溃，剩下的文件改用单个工作进程
+        按顺序解析，此时第一个没有结果的文件就是崩溃的文件，记为出错后从下一个继续
+        """
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = _submit_all(executor, _parse_one, keys)
+            keys = keys[len(futures):]
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    keys.append(futures[future])
+        keys.sort()
+        while keys:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                futures = list(_submit_all(executor, _parse_one, keys))
+                rest = keys[len(futures):]
+                for i, future in enumerate(futures):
+                    try:
+                        yield future.result()
+                    except BrokenProcessPool as e:
+                        yield keys[i], None, f"分析文件时出错: {str(e)}"
+                        rest = keys[i + 1:]
+                        break
+            keys = rest
+
+    def _load_cache(self, cache_path: str) -> Dict[str, Tuple[_CacheKey, Dict]]:
+        """读取解析结果缓存，版本不符或文件损坏时视为空缓存
+
+        缓存文件位于被分析的目录中，内容不可信，因此用 JSON 而不是 pickle
+        """
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict) or data.get('version') != SCHEMA_VERSION:
+                return {}
+            entries = {}
+            for file_path, (key, result) in data.get('entries', {}).items():
+                entries[file_path] = (_key_from_json(key), _result_from_json(result))
+            return entries
+        except Exception:
+            return {}
+
+    def _save_cache(self, cache_path: str, entries: Dict[str, Tuple[_CacheKey, Dict]]):
+        """写入解析结果缓存（先写临时文件再替换，避免中断时留下半个文件）"""
+        cache_dir = os.path.dirname(cache_path)
+        data = {
+            'version': SCHEMA_VERSION,
+            'entries': {file_path: (key, _result_to_json(result))
+                        for file_path, (key, result) in entries.items()},
+        }
+        tmp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # 临时文件名唯一，多个进程同时写缓存时互不干扰
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"[WARN] 写入缓存失败: {e}", file=sys.stderr)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     def print_report(self):
-        """打印分析报告"""
-        if not self.issues:
+        """打印分析报告；流式输出时问题已逐条输出，这里只打印汇总"""
+        if not self.issue_count:
             print("[OK] 未发现声明顺序异常！")
             return
 
-        print(f"发现 {len(self.issues)} 个潜在问题：\n")
-        print("=" * 80)
+        if self.stream:
+            print(f"\n发现 {self.issue_count} 个潜在问题")
+            return
 
-        # 按文件分组
-        by_file = defaultdict(list)
-        for file_path, line_num, message in self.issues:
-            by_file[file_path].append((line_num, message))
+        print(f"发现 {self.issue_count} 个潜在问题：\n")
+        print("=" * 80)
 
-        for file_path in sorted(by_file.keys()):
+        for file_path, file_issues in sorted(self.issues_by_file.items()):
             print(f"\n文件: {file_path}")
             print("-" * 80)
-            for line_num, message in sorted(by_file[file_path]):
+            for line_num, message in sorted(file_issues):
                 print(f"  行 {line_num:4d}: {message}")
 
 
+def _positive_int(value: str) -> int:
+    """argparse 类型：正整数"""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"需要正整数: {value!r}")
+    return number
+
+
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="检测Clojure文件中的声明顺序异常")
+    parser.add_argument('-j', '--jobs', type=_positive_int, default=None,
+                        help="并行分析的进程数（默认使用全部CPU核心，1 表示串行）")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="不读写 .cache/ 下的解析结果缓存")
+    parser.add_argument('--no-stream', action='store_false', dest='stream',
+                        help="分析结束后按文件汇总输出，而不是发现问题立即逐条输出")
+    args = parser.parse_args()
+
     # 获取项目根目录（脚本所在目录的父目录）
     script_dir = Path(__file__).parent
     root_dir = script_dir.parent
 
     print(f"分析目录: {root_dir}\n")
 
-    analyzer = ClojureAnalyzer()
-    analyzer.analyze_directory(str(root_dir))
+    analyzer = ClojureAnalyzer(stream=args.stream)
+    analyzer.analyze_directory(str(root_dir), jobs=args.jobs, use_cache=not args.no_cache)
     analyzer.print_report()
 
     # 如果有问题，返回非零退出码
-    if analyzer.issues:
+    if analyzer.issue_count:
         sys.exit(1)
     else:
         sys.exit(0)